@@ -3,18 +3,51 @@ from datetime import datetime
 import glob
 import os
 
+try:
+    import polars as pl
+except ImportError: # Optional fast path
+    pl = None
+
 file_paths = glob.glob(r'inputfiles/flowchartl02pdf/grading_results_*.csv')
 
+ex_cols = ['ex_4_grade', 'ex_5_grade', 'ex_6_grade', 'ex_7_grade', 'ex_8_grade', 'ex_9_grade']
+# Only read the columns we actually use
+usecols = ['file_path', 'status', 'total_grade', 'max_score', *ex_cols]
+score_cols = ['total_grade', 'max_score', *ex_cols]
+score_schema = {col: pl.Utf8 for col in score_cols} if pl is not None else None
+
+def _read_fast(path):
+    """Read the used columns of a results CSV, with polars if it is installed."""
+    if pl is not None:
+        # polars infers types from the first rows only and fails on grades
+        # like "N/A", so read scores as strings and convert them below
+        df = pl.read_csv(path, columns=usecols, schema_overrides=score_schema).to_pandas()
+    else:
+        df = pd.read_csv(path, engine='pyarrow', usecols=usecols)
+    # Non-numeric grades become NaN, like pandas does for "N/A"
+    df[score_cols] = df[score_cols].apply(pd.to_numeric, errors='coerce')
+    return df
+
 os.makedirs('outputfiles/flowchartl02pdf', exist_ok=True)
 for file_path in file_paths:
     print("Processing file:", file_path)
-    df = pd.read_csv(file_path)
-    if (df['status'] == 'success').all():
+    # Prefer the Parquet copy written by main.py when RESULTS_FORMAT=parquet
+    parquet_path = file_path[:-len('.csv')] + '.parquet'
+    if os.path.exists(parquet_path):
+        df = pd.read_parquet(parquet_path, columns=usecols)
+    else:
+        df = _read_fast(file_path)
+    # Few distinct statuses, so compare integer category codes instead of strings
+    df['status'] = df['status'].astype('category')
+    categories = df['status'].cat.categories
+    # NaN has code -1, so there is no code to compare when 'success' is missing
+    if 'success' in categories and (df['status'].cat.codes == categories.get_loc('success')).all():
         print("OK")
     else:
         print("ERROR")
     df2 = pd.DataFrame()
-    df2['name'] = df['file_path'].apply(lambda path: path.split('\\')[-2].split('_')[-3])
+    # Name comes from the submission's folder; accept both '\\' and '/' separators
+    df2['name'] = df['file_path'].str.replace('\\', '/', regex=False).str.rsplit('/', n=2).str[-2].str.rsplit('_', n=3).str[-3]
     df2['ex_4'] = df['ex_4_grade']
     df2['ex_5'] = df['ex_5_grade']
     df2['ex_6'] = df['ex_6_grade']
@@ -23,4 +56,5 @@ for file_path in file_paths:
     df2['ex_9'] = df['ex_9_grade']
     df2['score'] = df['total_grade']
     df2['max_score'] = df['max_score']
-    df2.to_csv(f'outputfiles/flowchartl02pdf/only_score_results_{file_path.split("\\")[-1]}', index=False)
\ No newline at end of file
+    # Scores read from Parquet are floats; print whole scores as "6", like the CSV input
+    df2.to_csv(f'outputfiles/flowchartl02pdf/only_score_results_{os.path.basename(file_path)}', index=False, float_format='%.15g')
\ No newline at end of file
@@ -1,9 +1,35 @@
 import unicodedata
 from pathlib import Path
 from docx2pdf import convert
+import subprocess
 import sys
 import time
 
+# Vietnamese letters with diacritics (lowercase; uppercase is added below)
+_VIETNAMESE_CHARS = (
+    "áàảãạâấầẩẫậăắằẳẵặ"
+    "éèẻẽẹêếềểễệ"
+    "íìỉĩị"
+    "óòỏõọôốồổỗộơớờởỡợ"
+    "úùủũụưứừửữự"
+    "ýỳỷỹỵ"
+)
+
+def _build_fold_table() -> dict:
+    """
+    Build a str.translate table folding Vietnamese letters to ASCII and
+    spaces to underscores, so normalize_name can avoid unicodedata for
+    the characters we actually encounter.
+    """
+    table = {ord('Đ'): 'D', ord('đ'): 'd', ord(' '): '_'}
+    for char in _VIETNAMESE_CHARS + _VIETNAMESE_CHARS.upper():
+        # e.g. 'ỗ' -> 'o' + '̂' + '̃' -> 'o'
+        base = unicodedata.normalize('NFD', char).encode('ascii', 'ignore').decode('ascii')
+        table[ord(char)] = base
+    return str.maketrans(table)
+
+_FOLD = _build_fold_table()
+
 def normalize_name(name: str) -> str:
     """
     Converts any non-ASCII characters to their closest ASCII equivalent
@@ -12,29 +38,40 @@ def normalize_name(name: str) -> str:
     Example: "một trái.docx" -> "mot_trai.docx"
     Example: "Đỗ.docx" -> "Do.docx"
     """
-    # Manually replace the Vietnamese 'D' characters FIRST.
-    # These are not decomposed by unicodedata.
-    name = name.replace('Đ', 'D')
-    name = name.replace('đ', 'd')
-    
-    # Decompose characters (e.g., 'ỗ' -> 'o' + '̂' + '̃')
-    # We use NFD (Normalization Form D) here.
-    nfd_form = unicodedata.normalize('NFD', name)
-    
-    # Encode to ASCII, ignoring non-ASCII bytes (the diacritics),
-    # then decode back to a string.
-    ascii_name = nfd_form.encode('ascii', 'ignore').decode('ascii')
+    # Fast path: nothing to fold
+    if name.isascii():
+        return name.replace(' ', '_')
     
-    # Replace spaces with underscores
-    normalized_name = ascii_name.replace(' ', '_')
+    # Fold Vietnamese letters (and 'Đ', which unicodedata does not
+    # decompose) with the precomputed table
+    folded_name = name.translate(_FOLD)
+    if folded_name.isascii():
+        return folded_name
     
-    return normalized_name
+    # Fall back for any other characters: decompose them (NFD) and drop
+    # the non-ASCII bytes (the diacritics)
+    nfd_form = unicodedata.normalize('NFD', folded_name)
+    return nfd_form.encode('ascii', 'ignore').decode('ascii')
+
+def _quit_word():
+    """
+    Quit the Word instance docx2pdf left open because of keep_active=True.
+    """
+    try:
+        if sys.platform == "win32":
+            import win32com.client
+            win32com.client.Dispatch("Word.Application").Quit()
+        elif sys.platform == "darwin":
+            subprocess.run(["osascript", "-e", 'tell application "Microsoft Word" to quit'], check=False)
+    except Exception as e:
+        print(f"Warning: Failed to quit Word: {e}")
 
 def process_directory(input_dir_str: str, output_dir_str: str):
     """
     Recursively finds all .docx files in the input directory,
     converts them to PDF, and saves them in the output directory
     with a mirrored, normalized folder structure.
+    Files whose PDF is already newer than the .docx are skipped.
     """
     
     input_dir = Path(input_dir_str)
@@ -53,6 +90,7 @@ def process_directory(input_dir_str: str, output_dir_str: str):
     
     start_time = time.time()
     converted_count = 0
+    skipped_count = 0
     failed_count = 0
     
     # Use rglob('*.docx') to recursively find all .docx files
@@ -64,45 +102,77 @@ def process_directory(input_dir_str: str, output_dir_str: str):
         
     print(f"Found {len(docx_files)} .docx files to process.")
 
-    for docx_path in docx_files:
-        try:
-            # 1. Get the path relative to the input directory
-            # e.g., "C:/me/doc1/một_trái.docx" -> "doc1/một_trái.docx"
-            relative_path = docx_path.relative_to(input_dir)
-            
-            # 2. Normalize the directory parts
-            # e.g., "doc1/sub folder" -> ["doc1", "sub_folder"]
-            normalized_dir_parts = [normalize_name(part) for part in relative_path.parent.parts]
-            
-            # 3. Normalize the file's base name (without extension)
-            # e.g., "một_trái" -> "mot_trai"
-            normalized_base_name = normalize_name(docx_path.stem)
-            
-            # 4. Create the new PDF filename
-            # e.g., "mot_trai.pdf"
-            pdf_filename = normalized_base_name + ".pdf"
-            
-            # 5. Combine the parts to create the final output path
-            # e.g., Path("C:/output_me") / "doc1" / "mot_trai.pdf"
-            final_output_path = output_dir.joinpath(*normalized_dir_parts, pdf_filename)
-            
-            # 6. Ensure the target directory exists
-            # e.g., "C:/output_me/doc1"
-            final_output_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            # 7. Perform the conversion
-            print(f"\nProcessing: {docx_path}")
-            print(f"  -> Output: {final_output_path}")
-            
-            # str() is used because docx2pdf expects string paths
-            convert(str(docx_path), str(final_output_path))
-            
-            print("  -> Success.")
-            converted_count += 1
-            
-        except Exception as e:
-            print(f"  -> [ERROR] Failed to convert {docx_path}: {e}")
-            failed_count += 1
+    # Files in the same folder share their normalized ancestors, so
+    # normalize each name and create each output folder only once
+    normalized_names = {}
+    output_dirs = {}
+    
+    def _norm(name):
+        normalized = normalized_names.get(name)
+        if normalized is None:
+            normalized = normalized_names[name] = normalize_name(name)
+        return normalized
+    
+    # Output path -> .docx it was converted from in this run
+    claimed_outputs = {}
+    word_started = False
+    
+    try:
+        for docx_path in docx_files:
+            try:
+                # 1. Get the path relative to the input directory
+                # e.g., "C:/me/doc1/một_trái.docx" -> "doc1/một_trái.docx"
+                relative_path = docx_path.relative_to(input_dir)
+                
+                # 2. Normalize the directory parts and ensure the target directory exists
+                # e.g., "doc1/sub folder" -> "C:/output_me/doc1/sub_folder"
+                target_dir = output_dirs.get(relative_path.parent)
+                if target_dir is None:
+                    normalized_dir_parts = [_norm(part) for part in relative_path.parent.parts]
+                    target_dir = output_dir.joinpath(*normalized_dir_parts)
+                    target_dir.mkdir(parents=True, exist_ok=True)
+                    output_dirs[relative_path.parent] = target_dir
+                
+                # 3. Normalize the file's base name (without extension)
+                # e.g., "một_trái" -> "mot_trai"
+                normalized_base_name = normalize_name(docx_path.stem)
+                
+                # 4. Combine the parts to create the final output path
+                # e.g., Path("C:/output_me") / "doc1" / "mot_trai.pdf"
+                final_output_path = target_dir / (normalized_base_name + ".pdf")
+                
+                print(f"\nProcessing: {docx_path}")
+                
+                # 5. Don't let two files that normalize to the same name
+                # (e.g. "Đỗ.docx" and "Do.docx") overwrite each other
+                if final_output_path in claimed_outputs:
+                    raise FileExistsError(f"{final_output_path} is already the output of {claimed_outputs[final_output_path]}")
+                claimed_outputs[final_output_path] = docx_path
+                
+                # 6. Skip files whose PDF is already newer than the .docx
+                if final_output_path.exists() and final_output_path.stat().st_mtime >= docx_path.stat().st_mtime:
+                    print("  -> Up-to-date, skipping.")
+                    skipped_count += 1
+                    continue
+                
+                # 7. Perform the conversion. docx2pdf drives a single Word
+                # instance, so conversions run one at a time; keep_active
+                # keeps Word open between files instead of restarting it
+                print(f"  -> Output: {final_output_path}")
+                
+                # str() is used because docx2pdf expects string paths
+                word_started = True
+                convert(str(docx_path), str(final_output_path), keep_active=True)
+                
+                print("  -> Success.")
+                converted_count += 1
+                
+            except Exception as e:
+                print(f"  -> [ERROR] Failed to convert {docx_path}: {e}")
+                failed_count += 1
+    finally:
+        if word_started:
+            _quit_word()
 
     # --- Summary ---
     end_time = time.time()
@@ -110,6 +180,7 @@ def process_directory(input_dir_str: str, output_dir_str: str):
     print("Conversion Complete")
     print(f"Total time: {end_time - start_time:.2f} seconds")
     print(f"Successfully converted: {converted_count}")
+    print(f"Up-to-date (skipped): {skipped_count}")
     print(f"Failed: {failed_count}")
     print("="*30)
 
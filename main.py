@@ -1,15 +1,83 @@
 import gradio as gr
 from google import genai 
 import os
-import glob
 import pandas as pd
 import time
 from datetime import datetime
+import atexit
+import csv
+import functools
+import hashlib
 import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 load_dotenv()
 import os
 
+MODEL_NAME = 'gemini-2.5-flash' # Using 2.5 Flash
+
+# Shared by the synchronous and batch paths so both grade identically
+GENERATION_CONFIG = {
+    'top_p': 0.5,
+    'temperature': 0.5,
+    'response_mime_type': 'application/json',
+    'thinking_config': {'thinking_budget': -1},
+}
+
+CSV_CORE_COLUMNS = [
+    'file_path', 'file_name', 'status', 'grade', 'total_grade', 
+    'max_score', 'is_complete', 'error', 'timestamp'
+]
+
+# Format of the results file: "csv", or "parquet" for faster handoff to
+# pandas scripts such as csvpostprocess.py (a CSV copy is still written)
+RESULTS_FORMAT = os.environ.get("RESULTS_FORMAT", "csv")
+
+# Lifetime of the cached grading prompt. Large runs can outlast it; once it
+# expires grade_file sends the prompt with each request instead
+PROMPT_CACHE_TTL = '3600s'
+# Names of prompt caches that expired mid-run, so later requests skip them
+_expired_caches = set()
+
+# Backoff for polling uploaded files until they are ACTIVE
+UPLOAD_POLL_INITIAL_DELAY = 0.1 # seconds
+UPLOAD_POLL_MAX_DELAY = 2 # seconds
+UPLOAD_PROCESSING_TIMEOUT = 120 # seconds
+# How often UploadTracker lists files during concurrent runs
+UPLOAD_TRACKER_INTERVAL = 1 # seconds
+UPLOAD_TRACKER_GET_LIMIT = 3 # with this few files pending, get them one by one instead of listing
+UPLOAD_TRACKER_PAGE_SIZE = 100 # files per files.list() page
+
+# Below this many files the batch job overhead outweighs its savings
+BATCH_MIN_FILES = 10
+BATCH_POLL_INTERVAL = 60 # seconds
+BATCH_TERMINAL_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+# Grading is almost pure network I/O, so several files can be in flight at once
+GRADER_WORKERS = int(os.environ.get("GRADER_WORKERS", 8))
+
+# Content hash -> Gemini file name, so identical contents are uploaded once
+_UPLOAD_CACHE: dict[str, str] = {}
+# Gemini file name -> number of graders currently using the upload. Identical
+# submissions graded concurrently share one upload, so it can only be deleted
+# once the last of them is done with it
+_upload_refs: dict[str, int] = {}
+# Gemini file name -> client, for unused uploads kept for a retry
+_kept_uploads: dict = {}
+_upload_cache_lock = threading.Lock()
+
+# Worker threads share debug.log, so serialize writes to it
+_debug_log_lock = threading.Lock()
+
+def _write_debug_log(header, result):
+    """Append a grading result to debug.log (thread-safe)."""
+    with _debug_log_lock:
+        with open('debug.log', 'a') as f:
+            print(header, file=f)
+            print(json.dumps(result, indent=4), file=f)
+
 # Configure Gemini API
 def configure_gemini_client(api_key):
     """Configure the Gemini API with the provided key and return a client."""
@@ -17,50 +85,115 @@ def configure_gemini_client(api_key):
 
 def scan_folder(folder_path, file_extensions):
     """Scan folder recursively and return list of files matching extensions."""
-    files = []
-    extensions = [ext.strip() for ext in file_extensions.split(',')]
+    extensions = tuple(
+        ext if ext.startswith('.') else '.' + ext
+        for ext in (ext.strip().lower() for ext in file_extensions.split(','))
+    )
     
-    for ext in extensions:
-        if not ext.startswith('.'):
-            ext = '.' + ext
-        pattern = os.path.join(folder_path, '**', f'*{ext}')
-        files.extend(glob.glob(pattern, recursive=True))
+    # Walk the tree once and match every file against all extensions
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        # Skip hidden folders and files, like glob does
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if not name.startswith('.') and name.lower().endswith(extensions):
+                files.append(os.path.join(root, name))
     
     return sorted(files)
 
+def _file_hash(file_path):
+    """Return the SHA-256 hex digest of a file's contents."""
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
 def upload_to_gemini(client, file_path): 
-    """Upload a file to Gemini and return the file object."""
+    """
+    Upload a file to Gemini and return the file object.
+    Files whose contents were already uploaded (e.g. when retrying, or
+    identical submissions) are reused instead of being uploaded again.
+    Every call must be paired with a release_upload call.
+    """
     try:
+        file_hash = _file_hash(file_path)
+        
+        # Take the reference under the lock, so the upload can't be deleted
+        # between the lookup and its use
+        with _upload_cache_lock:
+            cached_name = _UPLOAD_CACHE.get(file_hash)
+            if cached_name:
+                _upload_refs[cached_name] = _upload_refs.get(cached_name, 0) + 1
+                _kept_uploads.pop(cached_name, None)
+        if cached_name:
+            try:
+                uploaded_file = client.files.get(name=cached_name)
+            except Exception:
+                # Expired, deleted or uploaded with another API key
+                with _upload_cache_lock:
+                    _UPLOAD_CACHE.pop(file_hash, None)
+                    _upload_refs[cached_name] -= 1
+                    if not _upload_refs[cached_name]:
+                        del _upload_refs[cached_name]
+            else:
+                if uploaded_file.state.name != "FAILED":
+                    return uploaded_file
+                release_upload(client, uploaded_file)
+        
         # Use client.files.upload
         uploaded_file = client.files.upload(file=file_path) 
+        with _upload_cache_lock:
+            _UPLOAD_CACHE[file_hash] = uploaded_file.name
+            _upload_refs[uploaded_file.name] = 1
         return uploaded_file
     except Exception as e:
         raise Exception(f"Upload failed: {str(e)}")
 
-def grade_file(client, file_path, exercise_problem): 
+def _delete_file(client, name):
+    """Delete a file from Gemini, warning instead of raising on failure."""
+    try:
+        client.files.delete(name=name) 
+    except Exception as e:
+        print(f"Warning: Failed to delete file {name}. Error: {e}")
+
+def release_upload(client, uploaded_file, keep_for_retry=False):
     """
-    Grade a single file using Gemini API.
-    Returns a dictionary:
-    - On success: {'status': 'success', 'data': [list_of_exercise_results]}
-    - On failure: {'status': 'failed', 'error': 'error message'}
+    Release a file returned by upload_to_gemini. Once no grader uses it
+    any more it is deleted from Gemini, unless keep_for_retry is set, in
+    which case it stays cached for a retry until cleanup_kept_uploads.
     """
-    uploaded_file = None
-    model_name = 'gemini-2.5-flash' # Using 2.5 Flash
-    try:
-        # 1. Upload file to Gemini
-        uploaded_file = upload_to_gemini(client, file_path) 
-        
-        # 2. Wait for file to be processed
-        while uploaded_file.state.name == "PROCESSING":
-            time.sleep(2)
-            # Use client.files.get
-            uploaded_file = client.files.get(name=uploaded_file.name) 
-        
-        if uploaded_file.state.name == "FAILED":
-            raise Exception("File processing failed on Gemini's end")
-        
-        # 3. Create the grading prompt
-        system_prompt = f"""You are a **supportive and encouraging** automated grading assistant. Your primary goal is to find opportunities to **reward student effort and understanding**, not to needlessly penalize minor mistakes or differences in style.
+    name = uploaded_file.name
+    with _upload_cache_lock:
+        refs = _upload_refs.get(name, 1) - 1
+        if refs > 0:
+            _upload_refs[name] = refs
+            return
+        _upload_refs.pop(name, None)
+        cached_hashes = [h for h, cached_name in _UPLOAD_CACHE.items() if cached_name == name]
+        if keep_for_retry and cached_hashes:
+            _kept_uploads[name] = client
+            return
+        for file_hash in cached_hashes:
+            del _UPLOAD_CACHE[file_hash]
+    _delete_file(client, name)
+
+def cleanup_kept_uploads():
+    """
+    Delete uploads kept for retries that no grader is using. Runs when a
+    new grading run starts (the old results can no longer be retried) and
+    when the app exits.
+    """
+    with _upload_cache_lock:
+        kept = dict(_kept_uploads)
+        _kept_uploads.clear()
+        for file_hash in [h for h, name in _UPLOAD_CACHE.items() if name in kept]:
+            del _UPLOAD_CACHE[file_hash]
+    for name, client in kept.items():
+        _delete_file(client, name)
+
+atexit.register(cleanup_kept_uploads)
+
+
+# Grading prompt; only {exercise_problem} changes between runs
+_PROMPT_TEMPLATE = """You are a **supportive and encouraging** automated grading assistant. Your primary goal is to find opportunities to **reward student effort and understanding**, not to needlessly penalize minor mistakes or differences in style.
 
 You MUST provide your response as a single, valid JSON array.
 Do not include any text before or after the JSON array (e.g., do not write "Here is the JSON...").
@@ -86,47 +219,209 @@ EXERCISE PROBLEM(S):
 
 Now, please evaluate the following student submission file based on ALL the exercises listed above. Provide the JSON array response.
 """
+
+
+def _build_prompt(exercise_problem):
+    """Build the grading prompt for the given exercise problem(s)."""
+    return _PROMPT_TEMPLATE.format_map({'exercise_problem': exercise_problem})
+
+
+class UploadTracker:
+    """
+    Track the processing state of many uploads with a single background
+    thread that calls client.files.list() once per interval, instead of
+    every grading thread polling client.files.get() for its own file.
+    Listing stops as soon as every pending file has been seen, and with
+    only a few files pending they are fetched directly instead.
+    
+    Use as a context manager around a concurrent grading run and pass it
+    to _wait_for_active.
+    """
+
+    def __init__(self, client, interval=UPLOAD_TRACKER_INTERVAL):
+        self._client = client
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._events = {} # file name -> Event set once it leaves PROCESSING
+        self._files = {} # file name -> latest file object once done
+        self._waiters = {} # file name -> number of threads waiting on it
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def wait(self, uploaded_file, timeout):
+        """
+        Block until uploaded_file is no longer PROCESSING.
+        Returns its latest file object, or None on timeout.
+        Identical submissions share an upload, so several threads can wait
+        on the same file; its entry is kept until the last of them leaves.
+        """
+        name = uploaded_file.name
+        with self._lock:
+            event = self._events.setdefault(name, threading.Event())
+            self._waiters[name] = self._waiters.get(name, 0) + 1
+        event.wait(timeout)
+        with self._lock:
+            tracked_file = self._files.get(name)
+            self._waiters[name] -= 1
+            if not self._waiters[name]:
+                del self._waiters[name]
+                self._events.pop(name, None)
+                self._files.pop(name, None)
+            return tracked_file
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            with self._lock:
+                pending = {name for name, event in self._events.items() if not event.is_set()}
+            if not pending:
+                continue
+            try:
+                if len(pending) <= UPLOAD_TRACKER_GET_LIMIT:
+                    for name in pending:
+                        self._update(self._client.files.get(name=name))
+                    continue
+                # The pager fetches pages lazily, so stop once all pending
+                # files were seen instead of paging through every stored file
+                for f in self._client.files.list(config={'page_size': UPLOAD_TRACKER_PAGE_SIZE}):
+                    self._update(f)
+                    pending.discard(f.name)
+                    if not pending:
+                        break
+            except Exception as e:
+                print(f"Warning: Failed to check uploaded files. Error: {e}")
+
+    def _update(self, f):
+        with self._lock:
+            event = self._events.get(f.name)
+            if event and not event.is_set() and f.state.name != "PROCESSING":
+                self._files[f.name] = f
+                event.set()
+
+
+def _wait_for_active(client, uploaded_file, tracker=None):
+    """
+    Wait for an uploaded file to finish processing and return it.
+    With an UploadTracker the shared tracker thread does the polling.
+    Otherwise polls with exponential backoff, so small files that are ready
+    almost immediately don't wait a full poll interval. Files that are
+    already ACTIVE after upload skip polling entirely.
+    """
+    if tracker and uploaded_file.state.name == "PROCESSING":
+        tracked_file = tracker.wait(uploaded_file, UPLOAD_PROCESSING_TIMEOUT)
+        if tracked_file is None:
+            raise TimeoutError(f"File {uploaded_file.name} still processing after {UPLOAD_PROCESSING_TIMEOUT} seconds")
+        uploaded_file = tracked_file
+    
+    delay = UPLOAD_POLL_INITIAL_DELAY
+    deadline = time.time() + UPLOAD_PROCESSING_TIMEOUT
+    while uploaded_file.state.name == "PROCESSING":
+        if time.time() > deadline:
+            raise TimeoutError(f"File {uploaded_file.name} still processing after {UPLOAD_PROCESSING_TIMEOUT} seconds")
+        time.sleep(delay)
+        delay = min(delay * 1.5, UPLOAD_POLL_MAX_DELAY)
+        # Use client.files.get
+        uploaded_file = client.files.get(name=uploaded_file.name) 
+    
+    if uploaded_file.state.name == "FAILED":
+        raise Exception("File processing failed on Gemini's end")
+    
+    return uploaded_file
+
+
+def _parse_grading_response(response_text):
+    """
+    Parse the raw LLM response text into a grade_file style result dict.
+    """
+    try:
+        json_text = response_text.strip()
+        data = json.loads(json_text)
         
-        # 4. Generate summary
-        response = client.models.generate_content( 
-            model=model_name,
-            contents=[system_prompt, uploaded_file],
-            # Add generation_config to ensure JSON output
-            config=genai.types.GenerateContentConfig(
-                top_p=0.5,
-                temperature=0.5,
-                response_mime_type="application/json",
-                thinking_config=genai.types.ThinkingConfig(thinking_budget=-1)
-            )
-        )
+        if not isinstance(data, list):
+            raise json.JSONDecodeError("LLM did not return a JSON list.", json_text, 0)
         
-        # 5. Post-process to extract JSON
-        try:
-            json_text = response.text.strip()
-            data = json.loads(json_text)
-            
-            if not isinstance(data, list):
-                raise json.JSONDecodeError("LLM did not return a JSON list.", json_text, 0)
-            
-            if not data:
-                # Handle case where LLM returns empty list
-                 return {
-                    'status': 'failed',
-                    'error': 'Grader returned an empty result list.'
-                }
-
-            # NEW: Return the raw data list on success
-            return {
-                'status': 'success',
-                'data': data
-            }
-            
-        except json.JSONDecodeError as e:
-            # LLM failed to return valid JSON
+        if not data:
+            # Handle case where LLM returns empty list
             return {
                 'status': 'failed',
-                'error': f"Failed to parse LLM response. Raw: {response.text}"
+                'error': 'Grader returned an empty result list.'
             }
+
+        # NEW: Return the raw data list on success
+        return {
+            'status': 'success',
+            'data': data
+        }
+        
+    except json.JSONDecodeError as e:
+        # LLM failed to return valid JSON
+        return {
+            'status': 'failed',
+            'error': f"Failed to parse LLM response. Raw: {response_text}"
+        }
+
+
+def grade_file(client, file_path, system_prompt, cached_content=None, tracker=None): 
+    """
+    Grade a single file using Gemini API.
+    system_prompt is the prompt built by _build_prompt. If cached_content
+    names a context cache holding that prompt, only the uploaded file is
+    sent with the request. tracker is an optional UploadTracker used to
+    wait for the upload to finish processing.
+    Returns a dictionary:
+    - On success: {'status': 'success', 'data': [list_of_exercise_results]}
+    - On failure: {'status': 'failed', 'error': 'error message'}
+    """
+    uploaded_file = None
+    file_ready = False
+    graded = False
+    try:
+        # 1. Upload file to Gemini (reused if the same contents were uploaded before)
+        uploaded_file = upload_to_gemini(client, file_path) 
+        
+        # 2. Wait for file to be processed
+        uploaded_file = _wait_for_active(client, uploaded_file, tracker)
+        file_ready = True
+        
+        # 3. Create the grading prompt (unless it is already cached)
+        if cached_content in _expired_caches:
+            cached_content = None
+        if cached_content:
+            contents = [uploaded_file]
+        else:
+            contents = [system_prompt, uploaded_file]
+        
+        # 4. Generate summary
+        try:
+            response = client.models.generate_content( 
+                model=MODEL_NAME,
+                contents=contents,
+                # Add generation_config to ensure JSON output
+                config=genai.types.GenerateContentConfig(cached_content=cached_content, **GENERATION_CONFIG)
+            )
+        except Exception as e:
+            # The cache expired (or was deleted) during a long run; send the
+            # prompt inline instead of failing the file
+            if not cached_content or not _is_cache_error(e):
+                raise
+            _expired_caches.add(cached_content)
+            response = client.models.generate_content( 
+                model=MODEL_NAME,
+                contents=[system_prompt, uploaded_file],
+                config=genai.types.GenerateContentConfig(**GENERATION_CONFIG)
+            )
+        
+        # 5. Post-process to extract JSON
+        result = _parse_grading_response(response.text)
+        graded = result['status'] == 'success'
+        return result
         
     except Exception as e:
         return {
@@ -134,12 +429,57 @@ Now, please evaluate the following student submission file based on ALL the exer
             'error': str(e)
         }
     finally:
-        # 6. Clean up uploaded file
+        # 6. Clean up uploaded file. An ACTIVE file that failed to grade
+        # (e.g. malformed JSON) is kept so a retry can skip the upload.
         if uploaded_file:
-            try:
-                client.files.delete(name=uploaded_file.name) 
-            except Exception as e:
-                print(f"Warning: Failed to delete file {uploaded_file.name}. Error: {e}")
+            release_upload(client, uploaded_file, keep_for_retry=file_ready and not graded)
+
+
+def _create_prompt_cache(client, system_prompt):
+    """
+    Register the grading prompt (rubric + exercise problems) with Gemini's
+    Context Caching so it is sent once per run instead of once per file.
+    Returns the cache, or None if it could not be created (e.g. the prompt
+    is below the model's minimum cacheable size).
+    """
+    try:
+        return client.caches.create(
+            model=MODEL_NAME,
+            config=genai.types.CreateCachedContentConfig(
+                contents=[system_prompt],
+                ttl=PROMPT_CACHE_TTL
+            )
+        )
+    except Exception as e:
+        print(f"Warning: Failed to cache the grading prompt, sending it with every request. Error: {e}")
+        return None
+
+
+def _is_cache_error(error):
+    """
+    Whether a generate_content error was caused by the context cache, e.g.
+    "CachedContent not found (or permission denied)" once its TTL expired.
+    """
+    return 'cache' in str(error).lower()
+
+
+def _delete_prompt_cache(client, cache):
+    """Delete a context cache created by _create_prompt_cache."""
+    if cache:
+        try:
+            client.caches.delete(name=cache.name)
+        except Exception as e:
+            print(f"Warning: Failed to delete cache {cache.name}. Error: {e}")
+
+
+@functools.lru_cache(maxsize=None)
+def _exercise_keys(exercise_id):
+    """
+    Return the (grade, feedback, attempted) CSV column names for an exercise.
+    Every file shares the same exercise ids, so the names are built once per
+    id instead of once per exercise of every file.
+    """
+    return f"ex_{exercise_id}_grade", f"ex_{exercise_id}_feedback", f"ex_{exercise_id}_attempted"
 
 
 def _flatten_results_to_row(result_data, file_result_dict):
@@ -178,9 +518,10 @@ def _flatten_results_to_row(result_data, file_result_dict):
         feedback_parts.append(f"**Exercise {exercise_id} (Grade: {grade}):**\n{feedback}\n")
         
         # Add dynamic columns for CSV
-        file_result_dict[f"ex_{exercise_id}_grade"] = grade
-        file_result_dict[f"ex_{exercise_id}_feedback"] = feedback
-        file_result_dict[f"ex_{exercise_id}_attempted"] = is_attempted
+        grade_key, feedback_key, attempted_key = _exercise_keys(str(exercise_id))
+        file_result_dict[grade_key] = grade
+        file_result_dict[feedback_key] = feedback
+        file_result_dict[attempted_key] = is_attempted
 
     # Add aggregated keys for UI
     file_result_dict['grade'] = f"{total_score} / {max_score}"
@@ -190,23 +531,168 @@ def _flatten_results_to_row(result_data, file_result_dict):
     file_result_dict['max_score'] = max_score
 
 
-def _get_csv_columns(dataframe):
-    """Helper to get ordered columns for CSV export."""
-    all_columns = dataframe.columns
-    core_cols = [
-        'file_path', 'file_name', 'status', 'grade', 'total_grade', 
-        'max_score', 'is_complete', 'error', 'timestamp'
-    ]
-    # Find all 'ex_...' columns and sort them
-    dynamic_cols = sorted([col for col in all_columns if col.startswith('ex_')])
+def _get_csv_columns(columns):
+    """Helper to get ordered columns for CSV export from the available column names."""
+    present_core_cols = set()
+    dynamic_cols = []
+    # Single pass: pick out the 'ex_...' columns and note which core columns exist
+    for col in columns:
+        if col.startswith('ex_'):
+            dynamic_cols.append(col)
+        elif col in CSV_CORE_COLUMNS:
+            present_core_cols.add(col)
+    dynamic_cols.sort()
     
     # Ensure we only include core_cols that actually exist
-    final_core_cols = [col for col in core_cols if col in all_columns]
+    final_core_cols = [col for col in CSV_CORE_COLUMNS if col in present_core_cols]
     
     return final_core_cols + dynamic_cols
 
 
-def process_submissions(api_key, folder_path, file_extensions, exercise_problem, progress=gr.Progress()):
+def _result_to_row(file_path, result):
+    """Build the flattened result row for a file from its grade_file result."""
+    file_result = {
+        'file_path': file_path,
+        'file_name': os.path.basename(file_path),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'retry_button': '🔄 Retry'
+    }
+
+    if result['status'] == 'success':
+        file_result['status'] = 'success'
+        file_result['error'] = ''
+        # Flatten the exercise data into the dict
+        _flatten_results_to_row(result['data'], file_result)
+    else:
+        file_result['status'] = 'failed'
+        file_result['error'] = result['error']
+        file_result['grade'] = ''
+        file_result['feedback'] = ''
+        file_result['is_complete'] = False
+        file_result['total_grade'] = 0
+        file_result['max_score'] = 0
+
+    return file_result
+
+
+def _grade_one(client, file_path, system_prompt, cached_content=None, tracker=None):
+    """Grade a single file and return its flattened result row."""
+    result = grade_file(client, file_path, system_prompt, cached_content, tracker)
+    
+    _write_debug_log(f"--- Processing {file_path} ---", result)
+    
+    return _result_to_row(file_path, result)
+
+
+def _write_results(df, output_path):
+    """
+    Write the results DataFrame to output_path.
+    A .parquet output also gets a human-readable CSV copy next to it.
+    """
+    # Get dynamic columns for CSV
+    df_columns = _get_csv_columns(df.columns)
+    df[df_columns].to_csv(_csv_path(output_path), index=False, encoding='utf-8-sig')
+    if output_path.endswith('.parquet'):
+        _write_parquet(df[df_columns], output_path)
+
+
+def _write_parquet(df, output_path):
+    """
+    Write the results as Parquet. Score columns are coerced to numbers, as
+    the model can return a non-numeric grade (e.g. 'N/A') that Arrow can't
+    store in a numeric column. If writing still fails, the stale Parquet
+    file is removed so readers fall back to the CSV.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col in ('total_grade', 'max_score') or (col.startswith('ex_') and col.endswith('_grade')):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    try:
+        df.to_parquet(output_path, compression='snappy', index=False)
+    except (ValueError, TypeError) as e:
+        print(f"Warning: Failed to write {output_path}, results are only in the CSV. Error: {e}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def _results_path(folder_path, output_format):
+    """Return a timestamped results file path in folder_path."""
+    return os.path.join(folder_path, f'grading_results_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{output_format}')
+
+
+def _csv_path(output_path):
+    """Return the CSV file written for a results file (itself, for a .csv)."""
+    return os.path.splitext(output_path)[0] + '.csv'
+
+
+class ResultsStreamWriter:
+    """
+    Append result rows to a CSV file as they are graded, so a crash keeps
+    the rows finished so far. Rows are written in completion order, so the
+    caller rewrites the file in scan order once the run finishes.
+    
+    The header is taken from the first successful row (failed rows carry no
+    'ex_...' columns); rows arriving before it are held back until then.
+    Columns missing from that header are left out of the partial file.
+    """
+
+    def __init__(self, csv_path):
+        # Large buffer and no per-row flush; the OS writes it out in blocks
+        self._file = open(csv_path, 'w', buffering=1 << 20, newline='', encoding='utf-8-sig')
+        self._writer = None
+        self._fieldnames = None
+        self._pending = []
+
+    def _start(self, header_row):
+        self._fieldnames = _get_csv_columns(header_row.keys())
+        self._writer = csv.DictWriter(self._file, fieldnames=self._fieldnames, restval='', extrasaction='ignore')
+        self._writer.writeheader()
+        self._writer.writerows(self._pending)
+        self._pending = []
+
+    def write(self, row):
+        if self._writer is None:
+            if row['status'] != 'success':
+                self._pending.append(row)
+                return
+            self._start(row)
+        self._writer.writerow(row)
+
+    def close(self):
+        if self._writer is None and self._pending:
+            self._start(self._pending[0])
+        self._file.close()
+
+
+def _summarize_results(df, results, total_files, output_path):
+    """Build the same tuple as process_submissions for saved results."""
+    success_count = len([r for r in results if r['status'] == 'success'])
+    failed_count = len([r for r in results if r['status'] == 'failed'])
+    status_msg = f"✅ Processed {total_files} submissions. Success: {success_count}, Failed: {failed_count}\nResults saved to: {output_path}"
+    
+    # Create display dataframe with buttons
+    display_columns = ['file_name', 'status', 'grade', 'feedback', 'error', 'timestamp', 'retry_button']
+    display_df = df[display_columns].copy()
+    
+    return status_msg, display_df, results, output_path
+
+
+def _save_results(folder_path, results, total_files, output_format=RESULTS_FORMAT):
+    """
+    Save the results to a timestamped file in folder_path.
+    Returns the same tuple as process_submissions.
+    """
+    # Create DataFrame
+    df = pd.DataFrame(results)
+    
+    # Save to CSV (or Parquet + CSV)
+    output_path = _results_path(folder_path, output_format)
+    _write_results(df, output_path)
+    
+    return _summarize_results(df, results, total_files, output_path)
+
+
+def process_submissions(api_key, folder_path, file_extensions, exercise_problem, progress=gr.Progress(), output_format=RESULTS_FORMAT):
     """Process all files in the folder and generate grades."""
     if not api_key:
         return "Please provide a Gemini API key", None, [], None
@@ -221,6 +707,9 @@ def process_submissions(api_key, folder_path, file_extensions, exercise_problem,
         # Configure Gemini
         client = configure_gemini_client(api_key) 
         
+        # Results of an earlier run can't be retried any more
+        cleanup_kept_uploads()
+        
         # Scan for files
         progress(0, desc="Scanning folder...")
         files = scan_folder(folder_path, file_extensions)
@@ -228,66 +717,188 @@ def process_submissions(api_key, folder_path, file_extensions, exercise_problem,
         if not files:
             return f"No submission files found with extensions: {file_extensions}", None, [], None
         
-        # Process each file
-        results = []
+        # Process files concurrently; results keep the scan order
+        results = [None] * len(files)
         
-        for idx, file_path in enumerate(files):
-            progress((idx / len(files)), desc=f"Grading {idx + 1}/{len(files)}: {os.path.basename(file_path)}")
-            
-            result = grade_file(client, file_path, exercise_problem)
-            
-            with open('debug.log', 'a') as f:
-                print(f"--- Processing {file_path} ---", file=f)
-                print(json.dumps(result, indent=4), file=f)
-            
-            file_result = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'retry_button': '🔄 Retry'
-            }
-
-            if result['status'] == 'success':
-                file_result['status'] = 'success'
-                file_result['error'] = ''
-                # Flatten the exercise data into the dict
-                _flatten_results_to_row(result['data'], file_result)
-            else:
-                file_result['status'] = 'failed'
-                file_result['error'] = result['error']
-                file_result['grade'] = ''
-                file_result['feedback'] = ''
-                file_result['is_complete'] = False
-                file_result['total_grade'] = 0
-                file_result['max_score'] = 0
-
-            results.append(file_result)
+        # Rows are streamed to the CSV as they finish, so a crash keeps them
+        output_path = _results_path(folder_path, output_format)
+        stream_writer = ResultsStreamWriter(_csv_path(output_path))
+        
+        system_prompt = _build_prompt(exercise_problem)
+        cache = _create_prompt_cache(client, system_prompt)
+        cached_content = cache.name if cache else None
+        try:
+            with UploadTracker(client) as tracker, ThreadPoolExecutor(max_workers=GRADER_WORKERS) as executor:
+                futures = {
+                    executor.submit(_grade_one, client, file_path, system_prompt, cached_content, tracker): idx
+                    for idx, file_path in enumerate(files)
+                }
+                for done, future in enumerate(as_completed(futures)):
+                    idx = futures[future]
+                    results[idx] = future.result()
+                    stream_writer.write(results[idx])
+                    progress((done + 1) / len(files), desc=f"Graded {done + 1}/{len(files)}: {os.path.basename(files[idx])}")
+        finally:
+            stream_writer.close()
+            _delete_prompt_cache(client, cache)
         
         # Create DataFrame
         df = pd.DataFrame(results)
         
-        # Save to CSV
-        output_path = os.path.join(folder_path, f'grading_results_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv')
+        # Replace the streamed (completion order) CSV with the full results
+        # in scan order, so the delivered file is the same on every run
+        _write_results(df, output_path)
         
-        # Get dynamic columns for CSV
-        df_columns = _get_csv_columns(df)
-        df[df_columns].to_csv(output_path, index=False, encoding='utf-8-sig')
+        return _summarize_results(df, results, len(files), output_path)
+    
+    except Exception as e:
+        return f"❌ Error: {str(e)}", None, [], None
+
+
+def _upload_and_wait(client, file_path, tracker=None):
+    """Upload a file and wait until it is ACTIVE on Gemini's end."""
+    uploaded_file = upload_to_gemini(client, file_path)
+    try:
+        return _wait_for_active(client, uploaded_file, tracker)
+    except Exception:
+        release_upload(client, uploaded_file)
+        raise
+
+
+def _batch_request_line(file_path, system_prompt, uploaded_file):
+    """Build one JSONL line of a Gemini batch job for a single submission."""
+    return json.dumps({
+        'key': file_path,
+        'request': {
+            'contents': [{
+                'role': 'user',
+                'parts': [
+                    {'text': system_prompt},
+                    {'file_data': {'file_uri': uploaded_file.uri, 'mime_type': uploaded_file.mime_type}}
+                ]
+            }],
+            'generation_config': GENERATION_CONFIG
+        }
+    }, ensure_ascii=False)
+
+
+def _batch_line_to_result(line):
+    """Convert one line of a batch job's output file into a grade_file style result dict."""
+    if 'error' in line:
+        return {'status': 'failed', 'error': f"Batch request failed: {line['error']}"}
+    try:
+        parts = line['response']['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        return {'status': 'failed', 'error': f"Batch response had no content. Raw: {line.get('response')}"}
+    # Skip thought summaries, keep only the answer text
+    response_text = ''.join(part.get('text', '') for part in parts if not part.get('thought'))
+    return _parse_grading_response(response_text)
+
+
+def process_submissions_batch(api_key, folder_path, file_extensions, exercise_problem, progress=gr.Progress(), output_format=RESULTS_FORMAT):
+    """
+    Grade all files in the folder as a single Gemini batch job.
+    Batch Mode is cheaper but asynchronous, so small runs fall back to process_submissions.
+    """
+    if not api_key:
+        return "Please provide a Gemini API key", None, [], None
+    
+    if not folder_path or not os.path.exists(folder_path):
+        return "Please provide a valid folder path for submissions", None, [], None
+    
+    if not exercise_problem.strip():
+        return "Please paste the exercise problem statement(s)", None, [], None
+    
+    progress(0, desc="Scanning folder...")
+    files = scan_folder(folder_path, file_extensions)
+    
+    if len(files) < BATCH_MIN_FILES:
+        return process_submissions(api_key, folder_path, file_extensions, exercise_problem, progress, output_format)
+    
+    client = None
+    uploaded_files = {}
+    batch_results = {}
+    requests_file = None
+    try:
+        # Configure Gemini
+        client = configure_gemini_client(api_key)
+        system_prompt = _build_prompt(exercise_problem)
+        cleanup_kept_uploads()
         
-        success_count = len([r for r in results if r['status'] == 'success'])
-        failed_count = len([r for r in results if r['status'] == 'failed'])
-        status_msg = f"✅ Processed {len(files)} submissions. Success: {success_count}, Failed: {failed_count}\nResults saved to: {output_path}"
+        # 1. Upload every submission once
+        upload_errors = {}
+        with UploadTracker(client) as tracker, ThreadPoolExecutor(max_workers=GRADER_WORKERS) as executor:
+            futures = {executor.submit(_upload_and_wait, client, file_path, tracker): file_path for file_path in files}
+            for done, future in enumerate(as_completed(futures)):
+                file_path = futures[future]
+                try:
+                    uploaded_files[file_path] = future.result()
+                except Exception as e:
+                    upload_errors[file_path] = str(e)
+                progress((done + 1) / len(files), desc=f"Uploaded {done + 1}/{len(files)}: {os.path.basename(file_path)}")
         
-        # Create display dataframe with buttons
-        display_columns = ['file_name', 'status', 'grade', 'feedback', 'error', 'timestamp', 'retry_button']
-        display_df = df[display_columns].copy()
+        if not uploaded_files:
+            raise Exception(f"All uploads failed. First error: {next(iter(upload_errors.values()))}")
+        
+        # 2. Write the JSONL request file and submit the batch job
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+            for file_path, uploaded_file in uploaded_files.items():
+                print(_batch_request_line(file_path, system_prompt, uploaded_file), file=f)
+        
+        requests_file = client.files.upload(
+            file=f.name,
+            config=genai.types.UploadFileConfig(mime_type='jsonl')
+        )
+        os.remove(f.name)
+        
+        batch_job = client.batches.create(
+            model=MODEL_NAME,
+            src=requests_file.name,
+            config={'display_name': f'grading_{datetime.now().strftime("%Y%m%d_%H%M%S")}'}
+        )
+        
+        # 3. Wait for the job to finish
+        started = time.time()
+        while batch_job.state.name not in BATCH_TERMINAL_STATES:
+            progress(None, desc=f"Waiting for batch job {batch_job.name} ({int(time.time() - started)}s elapsed)...")
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch_job = client.batches.get(name=batch_job.name)
+        
+        if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+            raise Exception(f"Batch job ended with state {batch_job.state.name}: {batch_job.error}")
+        
+        # 4. Download and route each keyed response
+        output = client.files.download(file=batch_job.dest.file_name).decode('utf-8')
+        for raw_line in output.splitlines():
+            if raw_line.strip():
+                line = json.loads(raw_line)
+                batch_results[line['key']] = _batch_line_to_result(line)
         
-        return status_msg, display_df, results, output_path
+        results = []
+        for file_path in files:
+            if file_path in upload_errors:
+                result = {'status': 'failed', 'error': f"Upload failed: {upload_errors[file_path]}"}
+            else:
+                result = batch_results.get(file_path, {'status': 'failed', 'error': 'Missing from batch job output.'})
+            
+            _write_debug_log(f"--- Processing {file_path} (batch) ---", result)
+            results.append(_result_to_row(file_path, result))
+        
+        return _save_results(folder_path, results, len(files), output_format)
     
     except Exception as e:
         return f"❌ Error: {str(e)}", None, [], None
+    finally:
+        # Clean up uploaded files, keeping failed submissions for retries
+        if client:
+            for file_path, uploaded_file in uploaded_files.items():
+                graded = batch_results.get(file_path, {}).get('status') == 'success'
+                release_upload(client, uploaded_file, keep_for_retry=not graded)
+            if requests_file:
+                _delete_file(client, requests_file.name)
 
 
-def _perform_grading_and_update_row(client, exercise_problem, results_data, row_index):
+def _perform_grading_and_update_row(client, system_prompt, results_data, row_index, cached_content=None, tracker=None):
     """
     Internal helper function to grade a single file and update the results_data list in-place.
     Returns the status ('success' or 'failed')
@@ -295,11 +906,9 @@ def _perform_grading_and_update_row(client, exercise_problem, results_data, row_
     file_info_to_update = results_data[row_index]
     file_path = file_info_to_update['file_path']
     
-    result = grade_file(client, file_path, exercise_problem)
+    result = grade_file(client, file_path, system_prompt, cached_content, tracker)
 
-    with open('debug.log', 'a') as f:
-        print(f"--- Retrying {file_path} ---", file=f)
-        print(json.dumps(result, indent=4), file=f)
+    _write_debug_log(f"--- Retrying {file_path} ---", result)
 
     # Clear old dynamic keys before adding new ones
     keys_to_remove = [k for k in file_info_to_update.keys() if k.startswith('ex_')]
@@ -347,14 +956,12 @@ def retry_single_grading(api_key, exercise_problem, results_data, csv_path, evt:
         client = configure_gemini_client(api_key) 
         file_name = results_data[row_index]['file_name']
 
-        status = _perform_grading_and_update_row(client, exercise_problem, results_data, row_index)
+        status = _perform_grading_and_update_row(client, _build_prompt(exercise_problem), results_data, row_index)
         
         # Update CSV
         df_save = pd.DataFrame(results_data)
         if csv_path and os.path.exists(os.path.dirname(csv_path)):
-            # Get dynamic columns for CSV
-            df_columns = _get_csv_columns(df_save)
-            df_save[df_columns].to_csv(csv_path, index=False, encoding='utf-8-sig')
+            _write_results(df_save, csv_path)
         
         # Create display for just the retried row
         retried_row_data = {
@@ -400,24 +1007,35 @@ def retry_all_failed(api_key, exercise_problem, results_data, csv_path, progress
         success_count = 0
         total_failed = len(failed_indices)
         
-        for i, row_index in enumerate(failed_indices):
-            file_name = results_data[row_index]['file_name']
-            progress((i / total_failed), desc=f"Retrying {i + 1}/{total_failed}: {file_name}")
-            
-            try:
-                status = _perform_grading_and_update_row(client, exercise_problem, results_data, row_index)
-                if status == 'success':
-                    success_count += 1
-            except Exception as e:
-                results_data[row_index]['status'] = 'failed'
-                results_data[row_index]['error'] = f"Critical retry error: {str(e)}"
+        # Each worker updates a distinct row of results_data in-place
+        system_prompt = _build_prompt(exercise_problem)
+        cache = _create_prompt_cache(client, system_prompt)
+        cached_content = cache.name if cache else None
+        try:
+            with UploadTracker(client) as tracker, ThreadPoolExecutor(max_workers=GRADER_WORKERS) as executor:
+                futures = {
+                    executor.submit(_perform_grading_and_update_row, client, system_prompt, results_data, row_index, cached_content, tracker): row_index
+                    for row_index in failed_indices
+                }
+                for i, future in enumerate(as_completed(futures)):
+                    row_index = futures[future]
+                    file_name = results_data[row_index]['file_name']
+                    progress(((i + 1) / total_failed), desc=f"Retried {i + 1}/{total_failed}: {file_name}")
+                    
+                    try:
+                        status = future.result()
+                        if status == 'success':
+                            success_count += 1
+                    except Exception as e:
+                        results_data[row_index]['status'] = 'failed'
+                        results_data[row_index]['error'] = f"Critical retry error: {str(e)}"
+        finally:
+            _delete_prompt_cache(client, cache)
                 
         # Update CSV
         df_save = pd.DataFrame(results_data)
         if csv_path and os.path.exists(os.path.dirname(csv_path)):
-            # Get dynamic columns for CSV
-            df_columns = _get_csv_columns(df_save)
-            df_save[df_columns].to_csv(csv_path, index=False, encoding='utf-8-sig')
+            _write_results(df_save, csv_path)
         
         # Create new full display dataframe
         display_columns = ['file_name', 'status', 'grade', 'feedback', 'error', 'timestamp', 'retry_button']
@@ -467,6 +1085,7 @@ with gr.Blocks(title="Gemini Automated Grading System", theme=gr.themes.Soft())
                 process_btn = gr.Button("🚀 Grade Submissions", variant="primary", scale=2)
                 # NEW "Retry All Failed" button
                 retry_failed_btn = gr.Button("🔄 Retry All Failed", variant="secondary", scale=1)
+            batch_btn = gr.Button("📦 Grade as Batch Job (cheaper, slower)", variant="secondary")
 
         with gr.Column(scale=1):
             gr.Markdown("### Instructions")
@@ -477,6 +1096,7 @@ with gr.Blocks(title="Gemini Automated Grading System", theme=gr.themes.Soft())
             4. Paste the **full exercise problem(s)** into the text box.
                 - **Important:** If you have multiple exercises, list them clearly (e.g., "1. Do X", "2. Do Y"). The AI will grade each one.
             5. Click "Grade Submissions" to start.
+                - For large classes, "Grade as Batch Job" is about half the cost but can take much longer to finish.
             6. A CSV file with all results (including columns per exercise) will be saved in the submissions folder.
             7. Click the 🔄 **Retry** button on any *single* failed row to re-grade it.
             8. Click the 🔄 **Retry All Failed** button to re-grade *all* failed rows.
@@ -514,6 +1134,12 @@ with gr.Blocks(title="Gemini Automated Grading System", theme=gr.themes.Soft())
         outputs=[status_output, results_df, results_state, csv_path_state]
     )
     
+    batch_btn.click(
+        fn=process_submissions_batch,
+        inputs=[api_key_input, folder_input, extensions_input, exercise_problem_input],
+        outputs=[status_output, results_df, results_state, csv_path_state]
+    )
+    
     # NEW handler for "Retry All Failed"
     retry_failed_btn.click(
         fn=retry_all_failed,